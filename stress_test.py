@@ -1,136 +1,374 @@
 import asyncio
 import aiohttp
+from yarl import URL
 import json
 import csv
 import time
 import os
+import math
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from collections import defaultdict
 from datetime import datetime
 
+try:
+    import orjson
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+except ImportError:  # orjson è opzionale: senza, si usa il modulo json standard
+    _json_loads = json.loads
+
+    def _json_dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+
+try:
+    import uvloop
+except ImportError:  # uvloop è opzionale: senza, si usa l'event loop standard
+    uvloop = None
+
 # Configurazione percorsi
 CONFIG_FILE = 'config.json'
 LOG_DIR = 'logs'
 TIMESTAMP = datetime.now().strftime("%Y%m%d_%H%M%S")
 DETAIL_CSV = os.path.join(LOG_DIR, f'stress_log_{TIMESTAMP}.csv')
 SUMMARY_CSV = os.path.join(LOG_DIR, f'stress_summary_{TIMESTAMP}.csv')
+DETAIL_FLUSH_EVERY = 1000  # Righe di dettaglio tra un flush e l'altro
+LOG_QUEUE_SIZE = 10_000  # Righe in attesa di scrittura prima di rallentare i worker
+LOG_BATCH_SIZE = 500  # Righe scritte sul CSV in un colpo solo
+LOG_BATCH_TIMEOUT = 0.1  # Secondi di attesa massima prima di scrivere un blocco parziale
+STATUS_INTERVAL = 1.0  # Secondi tra una riga di avanzamento e l'altra
+SNIPPET_CHARS = 50  # Caratteri del body riportati nello snippet
+SNIPPET_BYTES = SNIPPET_CHARS * 4  # Byte letti: bastano per 50 caratteri anche in UTF-8 multi-byte
+CSV_CHUNK_BYTES = 1 << 16  # Byte accumulati prima di ogni write sul log di dettaglio
+DETAIL_HEADER = 'Timestamp,Global_ID,Worker,Method,URL,Status,Duration(s),Response_Snippet\r\n'
+
+# Per lo snippet: spazi al posto degli a capo e virgolette già raddoppiate
+# per il campo CSV quotato, tutto in un solo passaggio di str.translate.
+_SNIPPET_TABLE = str.maketrans({'\n': ' ', '\r': ' ', '\t': ' ', '"': '""'})
+
+
+def _decode_snippet(raw, charset):
+    """
+    Decodifica lo snippet col charset della risposta. Un charset sconosciuto
+    (es. "binary", "utf8mb4") ripiega su UTF-8, come fa response.text().
+    """
+    try:
+        return raw.decode(charset or 'utf-8', errors='replace')
+    except (LookupError, TypeError):
+        return raw.decode('utf-8', errors='replace')
+
+
+def _csv_field(value):
+    """Quota un campo CSV solo se contiene caratteri speciali (come csv.writer)."""
+    if any(c in value for c in ',"\r\n'):
+        return '"' + value.replace('"', '""') + '"'
+    return value
 
 
 class StressTester:
     def __init__(self, config_path):
-        with open(config_path, 'r') as f:
-            self.config = json.load(f)
+        with open(config_path, 'rb') as f:
+            self.config = _json_loads(f.read())
 
         # Rinominato per chiarezza: la lista dei target disponibili
         self.targets = self.config.get('targets', [])
         self.parallel = self.config.get('parallel_users', 1)
         self.total_reqs = self.config.get('total_requests', 10)
         self.delay = self.config.get('delay_ms', 0) / 1000.0
+        self.log_body = self.config.get('log_body', True)
+        # Con verbose attivo si stampa una riga per ogni richiesta
+        self.verbose = self.config.get('verbose', False)
+        self._done = 0
 
-        self.stats = defaultdict(list)
+        # Target normalizzati una volta sola:
+        # (method, url, kwargs, chiave_stats, campi_csv "METHOD,URL", url_yarl)
+        self._prepared = [self._prepare_target(t) for t in self.targets]
+        # Una coroutine di chiamata specializzata per ogni target
+        self._fetchers = [self._make_fetcher(p) for p in self._prepared]
+
+        # (method, url, status code) -> [count, somma, min, max] delle durate
+        self.stats = defaultdict(lambda: [0, 0.0, math.inf, -math.inf])
         os.makedirs(LOG_DIR, exist_ok=True)
 
-    def init_csv(self):
-        with open(DETAIL_CSV, mode='w', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            # Aggiunta colonna Global_ID per tracciare l'ordine globale
-            writer.writerow(
-                ['Timestamp', 'Global_ID', 'Worker', 'Method', 'URL', 'Status', 'Duration(s)', 'Response_Snippet'])
+        # Un solo file aperto per tutto il test, con buffer ampio: evita
+        # open/close a ogni riga del log di dettaglio.
+        # Le righe sono formattate a mano (vedi _write_batch), quindi il
+        # file è aperto in binario e non passa da csv.writer.
+        self._detail_fh = open(DETAIL_CSV, mode='wb', buffering=1 << 20)
+        self._detail_rows = 0
+        self._log_q = None
+        # Thread dedicato alle scritture su disco, fuori dall'event loop
+        self._io_exec = ThreadPoolExecutor(max_workers=1)
+        # Cache del timestamp formattato: si ricalcola solo al cambio di secondo
+        self._ts_sec = None
+        self._ts_str = ''
+        # Aggiunta colonna Global_ID per tracciare l'ordine globale
+        self._detail_fh.write(DETAIL_HEADER.encode('utf-8'))
+
+    @staticmethod
+    def _prepare_target(target):
+        method = target['method'].upper()
+        url = target['url']
+        body = target.get('body')
 
-    def log_request(self, global_id, worker_name, method, url, status, duration, response_text):
-        snippet = response_text[:50].replace('\n', ' ') + "..." if response_text else "No Body"
+        kwargs = {}
+        if body and method in ('POST', 'PUT', 'PATCH'):
+            # Il body viene serializzato qui una volta sola, non a ogni richiesta
+            kwargs['data'] = _json_dumps(body)
+            kwargs['headers'] = {'Content-Type': 'application/json'}
 
-        with open(DETAIL_CSV, mode='a', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            writer.writerow([
-                datetime.now().isoformat(),
-                global_id,  # ID progressivo globale (1, 2, 3...)
-                worker_name,  # Chi ha eseguito il lavoro
-                method,
-                url,
-                status,
-                f"{duration:.4f}",
-                snippet
-            ])
-
-        key = (method, url)
-        self.stats[key].append({'code': status, 'time': duration})
-
-    async def fetch(self, session, item, worker_name):
+        csv_target = f"{_csv_field(method)},{_csv_field(url)}"
+        # URL già parsato: aiohttp lo usa così com'è, senza ri-parsarlo a ogni richiesta
+        url_obj = URL(url)
+        return method, url, kwargs, (method, url), csv_target, url_obj
+
+    def close(self):
+        # Righe rimaste in coda se il test è stato interrotto: vengono scritte
+        # dopo quelle già affidate al thread di I/O, prima di chiudere il file.
+        rows = []
+        while self._log_q is not None and not self._log_q.empty():
+            row = self._log_q.get_nowait()
+            if row is not None:
+                rows.append(row)
+        self._io_exec.shutdown(wait=True)
+        if rows:
+            self._write_batch(rows)
+        if not self._detail_fh.closed:
+            self._detail_fh.close()
+
+    def _timestamp(self):
+        now = time.time()
+        sec = int(now)
+        if sec != self._ts_sec:
+            self._ts_sec = sec
+            self._ts_str = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(sec))
+        return f"{self._ts_str}.{int((now - sec) * 1e6):06d}"
+
+    async def log_request(self, global_id, worker_name, key, csv_target, status, duration, response_text):
+        snippet = (response_text[:SNIPPET_CHARS].translate(_SNIPPET_TABLE) + "...") if response_text else "No Body"
+
+        # La scrittura su disco la fa _writer_loop: qui accodiamo soltanto la riga
+        await self._log_q.put((
+            self._timestamp(),
+            global_id,  # ID progressivo globale (1, 2, 3...)
+            worker_name,  # Chi ha eseguito il lavoro
+            csv_target,  # Method e URL già pronti per il CSV
+            status,
+            duration,
+            snippet
+        ))
+
+        acc = self.stats[key + (status,)]
+        acc[0] += 1
+        acc[1] += duration
+        if duration < acc[2]:
+            acc[2] = duration
+        if duration > acc[3]:
+            acc[3] = duration
+
+    def _write_batch(self, batch):
         """
-        Esegue la chiamata.
-        item è una tupla: (global_index, target_data)
+        Formatta le righe a mano in un buffer di byte e le scrive a blocchi.
+        Solo lo snippet può contenere virgole o virgolette, quindi è l'unico
+        campo che viene sempre quotato (le virgolette sono già raddoppiate
+        in log_request).
         """
-        global_id, target = item
-        url = target['url']
-        method = target['method'].upper()
-        body = target.get('body')
+        fh = self._detail_fh
+        buf = bytearray()
+        for ts, global_id, worker_name, csv_target, status, duration, snippet in batch:
+            buf += f'{ts},{global_id},{worker_name},{csv_target},{status},{duration:.4f},"{snippet}"\r\n'.encode('utf-8')
+            if len(buf) >= CSV_CHUNK_BYTES:
+                fh.write(buf)
+                buf.clear()
+        if buf:
+            fh.write(buf)
+
+        flushed_blocks = self._detail_rows // DETAIL_FLUSH_EVERY
+        self._detail_rows += len(batch)
+        if self._detail_rows // DETAIL_FLUSH_EVERY > flushed_blocks:
+            self._detail_fh.flush()
 
-        start_time = time.time()
-        response_text = ""
-        status = 0
+    def _submit_batch(self, batch):
+        """
+        Affida un blocco di righe al thread di I/O. Lo shield fa sì che un
+        Ctrl-C non annulli una scrittura già affidata.
+        """
+        return asyncio.shield(asyncio.wrap_future(self._io_exec.submit(self._write_batch, batch)))
 
+    async def _writer_loop(self):
+        """
+        Svuota la coda dei log scrivendo le righe sul CSV a blocchi.
+        Termina quando riceve il sentinel None.
+        """
+        batch = []
         try:
-            kwargs = {}
-            if body and method in ['POST', 'PUT', 'PATCH']:
-                kwargs['json'] = body
+            while True:
+                try:
+                    row = await asyncio.wait_for(self._log_q.get(), timeout=LOG_BATCH_TIMEOUT)
+                except asyncio.TimeoutError:
+                    # Coda ferma: scriviamo quello che abbiamo già raccolto
+                    if batch:
+                        batch, rows = [], batch
+                        await self._submit_batch(rows)
+                    continue
 
-            async with session.request(method, url, **kwargs) as response:
-                status = response.status
-                response_text = await response.text()
+                # Prendiamo tutto quello che è già in coda senza attese
+                while row is not None:
+                    batch.append(row)
+                    if len(batch) >= LOG_BATCH_SIZE:
+                        batch, rows = [], batch
+                        await self._submit_batch(rows)
+                    try:
+                        row = self._log_q.get_nowait()
+                    except asyncio.QueueEmpty:
+                        break
+                else:
+                    break
 
-        except Exception as e:
-            status = "ERROR"
-            response_text = str(e)
-        finally:
-            duration = time.time() - start_time
-            self.log_request(global_id, worker_name, method, url, status, duration, response_text)
-            print(f"[{worker_name}] Req #{global_id} -> {method} {url} ({status})")
+            if batch:
+                batch, rows = [], batch
+                await self._submit_batch(rows)
+        except asyncio.CancelledError:
+            # Test interrotto: le righe già raccolte vanno comunque scritte.
+            # Quelle ancora in coda le scrive close().
+            if batch:
+                self._io_exec.submit(self._write_batch, batch)
+            raise
 
-    async def worker(self, name, queue, session):
+    def _make_fetcher(self, prepared):
         """
-        Il worker non ha un indice. Prende solo il prossimo ticket dalla coda globale.
+        Costruisce la coroutine di chiamata dedicata a un target.
+        Method, URL, kwargs e chiavi di log sono fissati nella closure, quindi
+        a ogni richiesta non resta nulla da leggere o decidere sul target.
         """
-        while True:
+        method, url, kwargs, key, csv_target, url_obj = prepared
+        log_body = self.log_body
+        verbose = self.verbose
+        log_request = self.log_request
+        perf_counter = time.perf_counter
+
+        async def fetch(session, global_id, worker_name):
+            start = perf_counter()
+            response_text = ""
+            status = 0
+            raw = b''
+            charset = None
+
             try:
-                # Prende il prossimo task disponibile (ordine FIFO garantito)
-                item = queue.get_nowait()
-            except asyncio.QueueEmpty:
-                break
+                async with session.request(method, url_obj, **kwargs) as response:
+                    status = response.status
+                    if log_body:
+                        # read(n) restituisce solo ciò che è già arrivato:
+                        # si continua finché non ci sono SNIPPET_BYTES o il body finisce
+                        charset = response.charset
+                        while len(raw) < SNIPPET_BYTES:
+                            chunk = await response.content.read(SNIPPET_BYTES - len(raw))
+                            if not chunk:
+                                break
+                            raw += chunk
+                    # Il resto del body viene scaricato e scartato, così la
+                    # connessione torna pulita nel pool del connector
+                    async for _ in response.content.iter_any():
+                        pass
+
+            except Exception as e:
+                status = "ERROR"
+                response_text = str(e)
+            else:
+                # Decodifica fuori dalla richiesta: non può mai sostituire lo status reale
+                if raw:
+                    response_text = _decode_snippet(raw, charset)
+            finally:
+                duration = perf_counter() - start
+                await log_request(global_id, worker_name, key, csv_target, status, duration, response_text)
+                self._done += 1
+                if verbose:
+                    sys.stdout.write(f"[{worker_name}] Req #{global_id} -> {method} {url} ({status})\n")
+
+        return fetch
 
-            await self.fetch(session, item, name)
-            queue.task_done()
+    async def _status_loop(self):
+        """
+        Stampa l'avanzamento (richieste completate e rps) a intervalli regolari.
+        """
+        start = time.perf_counter()
+        last_done = 0
+        last_time = start
+        while True:
+            await asyncio.sleep(STATUS_INTERVAL)
+            now = time.perf_counter()
+            done = self._done
+            rps = (done - last_done) / (now - last_time)
+            sys.stdout.write(f"⏱  {done}/{self.total_reqs} reqs done, {rps:.1f} rps ({now - start:.0f}s)\n")
+            sys.stdout.flush()
+            last_done, last_time = done, now
+
+    async def _bounded_fetch(self, fetch, session, global_id, sem, slots):
+        """
+        Esegue una chiamata occupando uno slot libero. Slot e semaforo vengono
+        rilasciati a fine chiamata, dopo l'eventuale delay.
+        """
+        name = slots.pop()
+        try:
+            await fetch(session, global_id, name)
 
             if self.delay > 0:
                 await asyncio.sleep(self.delay)
+        finally:
+            slots.append(name)
+            sem.release()
 
     async def run(self):
-        self.init_csv()
-        queue = asyncio.Queue()
+        self._log_q = asyncio.Queue(maxsize=LOG_QUEUE_SIZE)
+        writer_task = asyncio.create_task(self._writer_loop())
+
+        # Il semaforo limita le chiamate in volo a parallel_users; gli slot
+        # danno un nome (W-1, W-2, ...) a chi esegue ogni chiamata nel log.
+        sem = asyncio.Semaphore(self.parallel)
+        slots = [f"W-{i + 1}" for i in reversed(range(self.parallel))]
 
-        # --- PREPARAZIONE CODA GLOBALE ---
-        # Qui definiamo l'ordine ESATTO delle chiamate.
-        # Se targets = [A, B] e total = 5 -> Coda: [A, B, A, B, A]
-        # I worker preleveranno in questo esatto ordine.
-        print("Preparazione coda globale condivisa...")
-        for i in range(self.total_reqs):
-            target = self.targets[i % len(self.targets)]
-            # Inseriamo nella coda una tupla: (NumeroProgressivo, DatiTarget)
-            queue.put_nowait((i + 1, target))
+        print(f"🚀 Starting Stress Test: {self.total_reqs} requests, {self.parallel} parallel users...")
 
-        print(f"🚀 Starting Stress Test: {self.total_reqs} requests in Global Queue, {self.parallel} workers...")
+        # Connector condiviso per tutta la durata del test: i worker riusano
+        # connessioni TCP/TLS già aperte invece di ricrearle a ogni chiamata.
+        connector = aiohttp.TCPConnector(
+            limit=self.parallel * 4,
+            limit_per_host=0,
+            ttl_dns_cache=300,
+            keepalive_timeout=75,
+            enable_cleanup_closed=True
+        )
+        timeout = aiohttp.ClientTimeout(total=30)
 
-        async with aiohttp.ClientSession() as session:
-            tasks = []
-            for i in range(self.parallel):
-                # Lanciamo i worker. Loro condivideranno la stessa istanza di 'queue'
-                task = asyncio.create_task(self.worker(f"W-{i + 1}", queue, session))
-                tasks.append(task)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            status_task = asyncio.create_task(self._status_loop())
 
-            await queue.join()
+            # L'ordine delle chiamate è fisso: l'indice i usa targets[i % len(targets)].
+            # Se targets = [A, B] e total = 5 -> [A, B, A, B, A]
+            # Un nuovo task nasce solo quando si libera uno slot, quindi in
+            # memoria restano al massimo parallel_users task alla volta.
+            fetchers = self._fetchers
+            pending = set()
+            for i in range(self.total_reqs):
+                await sem.acquire()
+                task = asyncio.create_task(
+                    self._bounded_fetch(fetchers[i % len(fetchers)], session, i + 1, sem, slots))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
 
-            for task in tasks:
-                task.cancel()
+            await asyncio.gather(*pending)
 
+            status_task.cancel()
+            try:
+                await status_task
+            except asyncio.CancelledError:
+                pass
+
+        # Sentinel: il writer scrive le ultime righe e termina
+        await self._log_q.put(None)
+        await writer_task
+        self._io_exec.shutdown(wait=True)
+        self._detail_fh.flush()
         self.generate_report()
         print(f"\n✅ Done. Logs saved in {LOG_DIR}/")
 
@@ -140,17 +378,25 @@ class StressTester:
             writer = csv.writer(f)
             writer.writerow(['Method', 'URL', 'Response Code', 'Count', 'Avg Duration(s)', 'Min', 'Max'])
 
-            for (method, url), data in self.stats.items():
-                codes = defaultdict(list)
-                for entry in data:
-                    codes[entry['code']].append(entry['time'])
+            # Righe raggruppate per target, nell'ordine del config
+            order = {p[3]: i for i, p in enumerate(self._prepared)}
+            for (method, url, code), (count, total, min_time, max_time) in sorted(
+                    self.stats.items(), key=lambda item: order[item[0][:2]]):
+                writer.writerow([
+                    method, url, code, count,
+                    f"{total / count:.4f}", f"{min_time:.4f}", f"{max_time:.4f}"
+                ])
+
 
-                for code, times in codes.items():
-                    avg_time = sum(times) / len(times)
-                    writer.writerow([
-                        method, url, code, len(times),
-                        f"{avg_time:.4f}", f"{min(times):.4f}", f"{max(times):.4f}"
-                    ])
+def run_async(coro):
+    """Esegue la coroutine principale, su uvloop se disponibile."""
+    if uvloop is None:
+        return asyncio.run(coro)
+    if sys.version_info >= (3, 11):
+        with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+            return runner.run(coro)
+    uvloop.install()
+    return asyncio.run(coro)
 
 
 if __name__ == "__main__":
@@ -160,7 +406,9 @@ if __name__ == "__main__":
 
     tester = StressTester(CONFIG_FILE)
     try:
-        asyncio.run(tester.run())
+        run_async(tester.run())
     except KeyboardInterrupt:
         print("\n🛑 Test interrotto manualmente.")
-        tester.generate_report()
\ No newline at end of file
+        tester.generate_report()
+    finally:
+        tester.close()